@@ -1,24 +1,62 @@
-from flask import Flask, jsonify, request, session, redirect, url_for, send_from_directory
+from flask import Flask, Response, abort, g, request, session, redirect, url_for, send_file
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_session import Session
+from cachelib import SimpleCache
+from werkzeug.middleware.profiler import ProfilerMiddleware
 from werkzeug.security import generate_password_hash, check_password_hash
 from pathlib import Path
 from PIL import Image
+from sortedcontainers import SortedList
+from collections import deque
+from functools import lru_cache
+import atexit
 import csv
-import json
+import gzip
+import hashlib
+import itertools
+import math
+import numpy as np
+import orjson
 import os
 import random
+import redis
 import secrets
 import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; replay_elo then runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(16))
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = './flask_session'
+# Keep sessions in memory rather than pickling them to disk on every request.
+# Set REDIS_URL to share sessions across processes and keep them over restarts.
+if os.environ.get('REDIS_URL'):
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(os.environ['REDIS_URL'], socket_timeout=0.25)
+else:
+    app.config['SESSION_TYPE'] = 'cachelib'
+    app.config['SESSION_CACHELIB'] = SimpleCache(threshold=10000)
+app.config['SESSION_KEY_PREFIX'] = 'elo:'
 app.config['SESSION_PERMANENT'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400 * 30  # 30 days
 Session(app)
 
+# Set X_SENDFILE=1 behind a front-end server (Apache mod_xsendfile, lighttpd) that
+# can send image files itself from the X-Sendfile header
+app.config['USE_X_SENDFILE'] = bool(os.environ.get('X_SENDFILE'))
+
+# Set PROFILE=<dir> to write a cProfile dump per request into that directory
+if os.environ.get('PROFILE'):
+    os.makedirs(os.environ['PROFILE'], exist_ok=True)
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=os.environ['PROFILE'],
+                                      restrictions=[30])
+
 # Auth setup
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -27,146 +65,456 @@ login_manager.login_view = 'login'
 DB_DIR = Path('databases')
 DB_DIR.mkdir(exist_ok=True)
 USERS_DB = DB_DIR / 'users.db'
+FLUSH_INTERVAL = 2  # seconds between background CSV flushes
+UNDO_DEPTH = 64  # comparisons that go_back can rewind
+GZIP_MIN_SIZE = 1024  # smaller JSON bodies are sent uncompressed
+CACHED_RANKING_LIMITS = (None, 10)  # the full list and the page's top-10 panel
 
 # Initialize users database
 def init_users_db():
-    conn = sqlite3.connect(USERS_DB)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password_hash TEXT)''')
+    conn = sqlite3.connect(USERS_DB, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password_hash TEXT)''')
     conn.commit()
-    conn.close()
+    return conn
 
-init_users_db()
+# One shared connection; the lock serialises its use across request threads
+users_db = init_users_db()
+users_db_lock = threading.Lock()
 
 class User(UserMixin):
     def __init__(self, id, username):
         self.id = id
         self.username = username
 
+# Users are never renamed or deleted, so a found row can be cached for good.
+# Misses aren't cached: an id with no row yet may be registered later.
+user_rows = {}  # Key: user_id
+
+def fetch_user_row(user_id):
+    row = user_rows.get(user_id)
+    if row is None:
+        with users_db_lock:
+            row = users_db.execute('SELECT id, username FROM users WHERE id = ?', (user_id,)).fetchone()
+        if row:
+            user_rows[user_id] = row
+    return row
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect(USERS_DB)
-    c = conn.cursor()
-    c.execute('SELECT id, username FROM users WHERE id = ?', (user_id,))
-    user = c.fetchone()
-    conn.close()
+    user = fetch_user_row(user_id)
     if user:
         return User(user[0], user[1])
     return None
 
+@njit(cache=True)
+def replay_elo(ratings, winners, losers, k_factor):
+    """Apply a chain of win/loss results to a ratings array in place"""
+    for n in range(winners.shape[0]):
+        w = winners[n]
+        l = losers[n]
+        r_w = ratings[w]
+        r_l = ratings[l]
+        delta = k_factor * (1.0 - 1.0 / (1.0 + 10.0 ** ((r_l - r_w) * 0.0025)))
+        ratings[w] = r_w + delta
+        ratings[l] = r_l - delta
+
+def csv_quote(field):
+    if ',' in field or '"' in field or '\n' in field or '\r' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+# Shared counter so every ranker state gets a distinct version stamp. Seeded from
+# the clock so a restart can't reuse an ETag a browser still holds for old rankings
+ranker_versions = itertools.count(time.time_ns())
+
 class EloRanker:
+    __slots__ = ('k_factor', 'item_names', 'item_index', 'ratings_arr', 'sorted_ratings',
+                 'comparisons', 'history', 'undo_floor', 'pair_sequence', 'current_index',
+                 'strategy', 'dirty', 'version', 'rankings_json', 'csv_path',
+                 'journal_path', 'journal', 'lock')
+    
     def __init__(self, items, k_factor=32, initial_rating=1500):
         self.k_factor = k_factor
-        self.ratings = {item: initial_rating for item in items}
-        self.rating_change_indices = set()
-        self.comparisons = []
-        self.items = items
-        self.history = []
+        # Ratings live in one packed array; item_index maps a name to its slot
+        self.item_names = list(dict.fromkeys(items))
+        self.item_index = {item: i for i, item in enumerate(self.item_names)}
+        self.ratings_arr = np.full(len(self.item_names), initial_rating, dtype=np.float64)
+        # (-rating, item) pairs, so iteration order is best-first
+        self.sorted_ratings = SortedList((-float(initial_rating), item) for item in self.item_names)
+        self.comparisons = deque(maxlen=UNDO_DEPTH)
+        # (pair index, item_a, old rating, item_b, old rating, global change) per rated pair
+        self.history = deque(maxlen=UNDO_DEPTH)
+        self.undo_floor = -1  # pair index of the newest entry history has dropped
         self.pair_sequence = []
         self.current_index = -1
         self.strategy = 'random'
+        self.dirty = False
+        self.version = next(ranker_versions)
+        self.rankings_json = {}  # Key: limit (None for the full list)
+        self.csv_path = None  # where flush() saves; set by load_ranker
+        # Append-only log of changes since the last CSV save, for crash recovery
+        self.journal_path = None
+        self.journal = None
+        self.lock = threading.RLock()
     
-    def expected_score(self, rating_a, rating_b):
-        return 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+    @staticmethod
+    def expected_score(rating_a, rating_b):
+        return 1.0 / (1.0 + 10.0 ** ((rating_b - rating_a) * 0.0025))  # / 400
     
-    def update_ratings(self, winner, loser):
-        self.history.append(dict(self.ratings))
-        self.rating_change_indices.add(self.current_index)
-        
-        r_winner = self.ratings[winner]
-        r_loser = self.ratings[loser]
-        
-        e_winner = self.expected_score(r_winner, r_loser)
-        e_loser = self.expected_score(r_loser, r_winner)
-        
-        self.ratings[winner] = r_winner + self.k_factor * (1 - e_winner)
-        self.ratings[loser] = r_loser + self.k_factor * (0 - e_loser)
-        
-        self.comparisons.append((winner, loser))
+    def canonical_item(self, name):
+        """Return the stored string for name, or None if it isn't an item here"""
+        i = self.item_index.get(name)
+        return None if i is None else self.item_names[i]
+    
+    def reindex(self):
+        """Rebuild the sorted index after writing ratings_arr directly"""
+        self.sorted_ratings = SortedList(zip((-self.ratings_arr).tolist(), self.item_names))
+        self.version = next(ranker_versions)
+        self.rankings_json = {}  # Key: limit (None for the full list)
+    
+    def get_rating(self, item):
+        return self.ratings_arr.item(self.item_index[item])
+    
+    def set_rating(self, item, rating):
+        """Update an item's rating and keep the sorted index in step"""
+        i = self.item_index[item]
+        self.sorted_ratings.remove((-self.ratings_arr.item(i), item))
+        self.ratings_arr[i] = rating
+        self.sorted_ratings.add((-rating, item))
+        self.version = next(ranker_versions)
+        self.rankings_json = {}  # Key: limit (None for the full list)
+    
+    def push_history(self, item_a, r_a, item_b, r_b, global_change=None):
+        if len(self.history) == self.history.maxlen:
+            self.undo_floor = self.history[0][0]
+        self.history.append((self.current_index, item_a, r_a, item_b, r_b, global_change))
+    
+    def has_rating_at(self, index):
+        """Whether the pair at index changed ratings that can still be undone"""
+        return bool(self.history) and self.history[-1][0] == index
+    
+    def global_change_at(self, index):
+        """The global ranker change made with the undoable rating at index, if any"""
+        return self.history[-1][5] if self.has_rating_at(index) else None
+    
+    @property
+    def is_replaying(self):
+        """Whether the current pair is a revisit rather than a fresh draw"""
+        return self.current_index < len(self.pair_sequence) - 1
+    
+    def write_journal(self, *record):
+        if self.journal_path is None:
+            return
+        # Opened on demand and closed again by flush(), so idle rankers hold no file
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'ab', buffering=0)
+        self.journal.write(orjson.dumps(record) + b'\n')
+    
+    def update_ratings(self, winner, loser, global_change=None):
+        """Apply a win and return it as (winner, delta, loser, delta) for revert()"""
+        with self.lock:
+            r_winner = self.get_rating(winner)
+            r_loser = self.get_rating(loser)
+            # Only the two touched ratings are needed to undo this comparison
+            self.push_history(winner, r_winner, loser, r_loser, global_change)
+            
+            # expected_score inlined: this runs on every comparison
+            e_winner = 1.0 / (1.0 + 10.0 ** ((r_loser - r_winner) * 0.0025))
+            e_loser = 1.0 - e_winner
+            
+            delta_winner = self.k_factor * (1 - e_winner)
+            delta_loser = self.k_factor * (0 - e_loser)
+            self.set_rating(winner, r_winner + delta_winner)
+            self.set_rating(loser, r_loser + delta_loser)
+            
+            self.comparisons.append((winner, loser))
+            self.write_journal('win', winner, loser)
+            self.dirty = True
+            return winner, delta_winner, loser, delta_loser
     
     def record_tie(self, item_a, item_b):
-        self.history.append(dict(self.ratings))
-        
-        r_a = self.ratings[item_a]
-        r_b = self.ratings[item_b]
-        
-        e_a = self.expected_score(r_a, r_b)
-        e_b = self.expected_score(r_b, r_a)
+        with self.lock:
+            r_a = self.get_rating(item_a)
+            r_b = self.get_rating(item_b)
+            self.push_history(item_a, r_a, item_b, r_b)
+            
+            e_a = 1.0 / (1.0 + 10.0 ** ((r_b - r_a) * 0.0025))
+            e_b = 1.0 - e_a
+            
+            new_a = r_a + self.k_factor * (0.5 - e_a)
+            new_b = r_b + self.k_factor * (0.5 - e_b)
+            self.set_rating(item_a, new_a)
+            self.set_rating(item_b, new_b)
+            
+            self.comparisons.append((item_a, item_b, 'tie'))
+            self.write_journal('set', item_a, new_a, item_b, new_b)
+            self.dirty = True
+    
+    def undo_last(self):
+        """Restore the two ratings touched by the most recent comparison"""
+        with self.lock:
+            if not self.history:
+                return False
+            _, item_a, r_a, item_b, r_b, _ = self.history.pop()
+            self.set_rating(item_a, r_a)
+            self.set_rating(item_b, r_b)
+            if self.comparisons:
+                self.comparisons.pop()
+            self.write_journal('undo', item_a, r_a, item_b, r_b)
+            self.dirty = True
+            return True
+    
+    def revert(self, change):
+        """Take back a change from update_ratings, keeping any made since by other users"""
+        with self.lock:
+            winner, delta_winner, loser, delta_loser = change
+            new_winner = self.get_rating(winner) - delta_winner
+            new_loser = self.get_rating(loser) - delta_loser
+            self.set_rating(winner, new_winner)
+            self.set_rating(loser, new_loser)
+            self.write_journal('set', winner, new_winner, loser, new_loser)
+            self.dirty = True
+    
+    def replay(self, winners, losers):
+        """Apply a batch of comparisons given as winner/loser slot indices (not undoable)"""
+        replay_elo(self.ratings_arr, np.asarray(winners, dtype=np.int32),
+                   np.asarray(losers, dtype=np.int32), float(self.k_factor))
+        self.reindex()
+        self.dirty = True
+    
+    def replay_journal(self, filepath):
+        """Re-apply changes journaled after the last CSV save"""
+        if not Path(filepath).exists():
+            return
         
-        self.ratings[item_a] = r_a + self.k_factor * (0.5 - e_a)
-        self.ratings[item_b] = r_b + self.k_factor * (0.5 - e_b)
+        # An undo cancels the latest surviving entry. One with nothing left to
+        # cancel reverts a change already in the CSV, and can only come before
+        # every surviving entry, so those restores are applied first.
+        restores = []
+        entries = []
+        with open(filepath, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    break  # torn last line from a crash mid-write
+                if record[0] != 'undo':
+                    entries.append(record)
+                elif entries:
+                    entries.pop()
+                else:
+                    restores.append(record)
         
-        self.comparisons.append((item_a, item_b, 'tie'))
+        wins = []
+        for record in restores + entries + [None]:
+            if record and record[0] == 'win':
+                if record[1] in self.item_index and record[2] in self.item_index:
+                    wins.append((self.item_index[record[1]], self.item_index[record[2]]))
+                continue
+            # Apply runs of wins in one batch before any explicit rating writes
+            if wins:
+                self.replay(*zip(*wins))
+                wins = []
+            if record:
+                _, item_a, r_a, item_b, r_b = record
+                for item, rating in ((item_a, r_a), (item_b, r_b)):
+                    if item in self.item_index:
+                        self.set_rating(item, rating)
+                self.dirty = True
+    
+    def settle_interrupted_flush(self):
+        """Sort out the files left by a flush() that was cut off part way"""
+        old_path = f'{self.journal_path}.old'
+        tmp_path = f'{self.csv_path}.tmp'
+        if os.path.exists(old_path):
+            if os.path.exists(tmp_path):
+                # The new CSV never replaced the old one, so the set-aside
+                # journal's changes are still missing from it
+                os.replace(old_path, self.journal_path)
+            else:
+                # The new CSV went live and already includes them
+                os.remove(old_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    def trim_torn_record(self):
+        """Cut off a record left half-written by a crash, so new ones don't append onto it"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+    
+    def open_journal(self, filepath):
+        """Recover from any journal left at filepath, then keep journaling to it"""
+        self.journal_path = filepath
+        self.settle_interrupted_flush()
+        self.trim_torn_record()
+        self.replay_journal(filepath)
+    
+    def flush(self):
+        """Save to csv_path if anything changed, then start a fresh journal"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            try:
+                self.save_snapshot()
+            except Exception:
+                self.dirty = True  # keep the changes queued for the next flush
+                raise
+    
+    def save_snapshot(self):
+        tmp_path = f'{self.csv_path}.tmp'
+        self.write_csv(tmp_path)
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            os.replace(tmp_path, self.csv_path)
+            return
+        # Set the journal aside before the new CSV goes live, so a crash at
+        # any point leaves its changes counted exactly once: while the .tmp
+        # is still there they are not in the CSV yet, and once it is gone they are
+        old_path = f'{self.journal_path}.old'
+        os.replace(self.journal_path, old_path)
+        try:
+            os.replace(tmp_path, self.csv_path)
+        except OSError:
+            # The old CSV is still the live one, so its journal must be too
+            os.replace(old_path, self.journal_path)
+            raise
+        os.remove(old_path)
     
     def go_back(self):
-        if self.current_index > 0:
-            # Only pop history if this index had a rating change
-            if self.current_index in self.rating_change_indices:
-                if self.history:
-                    self.ratings = self.history.pop()
-                if self.comparisons:
-                    self.comparisons.pop()
-                self.rating_change_indices.discard(self.current_index)
+        with self.lock:
+            if self.current_index > 0:
+                # Undo the rating of the pair we return to, since it will be judged again
+                target = self.current_index - 1
+                # Stop rather than step past changes we can no longer undo
+                if target <= self.undo_floor:
+                    return None
+                if self.has_rating_at(target):
+                    self.undo_last()
             
-            self.current_index -= 1
-            return self.pair_sequence[self.current_index]
-        return None
+                self.current_index = target
+                return self.pair_sequence[target]
+            return None
     
     def get_next_pair(self):
-        if self.current_index + 1 < len(self.pair_sequence):
-            self.current_index += 1
-            return self.pair_sequence[self.current_index]
-        
-        if self.strategy == 'random':
-            pair = random.sample(self.items, 2)
-        elif self.strategy == 'close':
-            sorted_items = sorted(self.items, key=lambda x: self.ratings[x])
-            idx = random.randint(0, len(sorted_items) - 2)
-            pair = [sorted_items[idx], sorted_items[idx + 1]]
-        elif self.strategy == 'weighted':
-            items_list = list(self.items)
-            item_a = random.choice(items_list)
-            rating_a = self.ratings[item_a]
-            candidates = [i for i in items_list if i != item_a]
-            weights = [1 / (1 + abs(self.ratings[i] - rating_a) / 100) for i in candidates]
-            item_b = random.choices(candidates, weights=weights)[0]
-            pair = [item_a, item_b]
-        
-        self.pair_sequence = self.pair_sequence[:self.current_index + 1]
-        self.pair_sequence.append(pair)
-        self.current_index = len(self.pair_sequence) - 1
-        
-        return pair
+        with self.lock:
+            if self.current_index + 1 < len(self.pair_sequence):
+                self.current_index += 1
+                return self.pair_sequence[self.current_index]
+            
+            if self.strategy == 'random':
+                # Draw j from the n - 1 other slots, shifting past i
+                n = len(self.item_names)
+                i = random.randrange(n)
+                j = random.randrange(n - 1)
+                j += j >= i
+                pair = [self.item_names[i], self.item_names[j]]
+            elif self.strategy == 'close':
+                idx = random.randrange(len(self.sorted_ratings) - 1)
+                pair = [self.sorted_ratings[idx][1], self.sorted_ratings[idx + 1][1]]
+            elif self.strategy == 'weighted':
+                idx_a = random.randrange(len(self.item_names))
+                weights = 1 / (1 + np.abs(self.ratings_arr - self.ratings_arr[idx_a]) / 100)
+                weights[idx_a] = 0
+                # Inverse-CDF draw; side='right' can never land on the zero-weight idx_a
+                cumulative = np.cumsum(weights)
+                idx_b = int(np.searchsorted(cumulative, random.random() * cumulative[-1], side='right'))
+                pair = [self.item_names[idx_a], self.item_names[idx_b]]
+            
+            self.pair_sequence.append(pair)
+            self.current_index = len(self.pair_sequence) - 1
+            
+            return pair
+    
+    def next_payload(self, db_name):
+        """Advance to the next pair and return the /get_pair response for it"""
+        with self.lock:
+            pair = self.get_next_pair()
+            is_replaying = self.is_replaying
+            current_index = self.current_index
+            sequence_length = len(self.pair_sequence)
+        return {
+            **pair_payload(db_name, pair),
+            'is_replaying': is_replaying,
+            'current_index': current_index,
+            'sequence_length': sequence_length
+        }
     
-    def get_rankings(self):
-        return sorted(self.ratings.items(), key=lambda x: x[1], reverse=True)
+    def get_rankings(self, limit=None):
+        # Under the lock, so a read never lands between set_rating's remove and add
+        with self.lock:
+            return [(item, -neg_rating) for neg_rating, item in self.sorted_ratings[:limit]]
     
-    def save_to_csv(self, filepath):
+    def get_rankings_json(self, limit=None):
+        """JSON-encoded rankings and the version they match, re-encoded only after a rating changes"""
+        with self.lock:
+            if limit is not None and limit >= len(self.item_names):
+                limit = None
+            # Cache only the limits the page uses, so arbitrary ?top= values
+            # can't pile up on a ranker every user shares
+            if limit not in CACHED_RANKING_LIMITS:
+                return orjson.dumps(self.get_rankings(limit)), self.version
+            if limit not in self.rankings_json:
+                self.rankings_json[limit] = orjson.dumps(self.get_rankings(limit))
+            return self.rankings_json[limit], self.version
+    
+    def write_csv(self, filepath):
+        # Build the whole file in memory, quoting names the way csv.writer would
+        rows = [
+            f'{csv_quote(item)},{rating!r}'
+            for item, rating in sorted(zip(self.item_names, self.ratings_arr.tolist()))
+        ]
         with open(filepath, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['item', 'rating'])
-            for item, rating in sorted(self.ratings.items()):
-                writer.writerow([item, rating])
+            f.write('item,rating\r\n' + '\r\n'.join(rows) + '\r\n')
     
     def load_from_csv(self, filepath):
         if not Path(filepath).exists():
             return
-        with open(filepath, 'r') as f:
-            reader = csv.DictReader(f)
+        item_index = self.item_index
+        ratings_arr = self.ratings_arr
+        with open(filepath, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # header
             for row in reader:
-                item = row['item']
-                if item in self.ratings:
-                    self.ratings[item] = float(row['rating'])
+                if len(row) != 2:
+                    continue  # blank or malformed line in a hand-edited file
+                i = item_index.get(row[0])
+                if i is None:
+                    continue
+                try:
+                    rating = float(row[1])
+                except ValueError:
+                    continue
+                # NaN or inf would break the ordering of sorted_ratings
+                if math.isfinite(rating):
+                    ratings_arr[i] = rating
+        self.reindex()
 
 # Separate storage for personal and global rankers
 personal_rankers = {}  # Key: (db_name, username)
 global_rankers = {}    # Key: db_name (shared across all users)
 current_db = {}        # Key: username
 
+# Directory listing cache, rescanned only when DB_DIR's mtime changes. Flushing
+# a ranker renames its CSV and journal files in DB_DIR, so while anyone is rating
+# this rescans up to once per FLUSH_INTERVAL; it is only scan-free when idle.
+db_list_cache = {'mtime': None, 'databases': []}
+
 def get_databases():
-    dbs = [f.stem for f in DB_DIR.glob('*.txt')]
-    return sorted(dbs) if dbs else []
+    mtime = DB_DIR.stat().st_mtime_ns
+    if mtime != db_list_cache['mtime']:
+        db_list_cache['databases'] = sorted(f.stem for f in DB_DIR.glob('*.txt'))
+        db_list_cache['mtime'] = mtime
+    return db_list_cache['databases']
 
 def get_csv_path(db_name, username, is_global=False):
     if is_global:
@@ -174,17 +522,78 @@ def get_csv_path(db_name, username, is_global=False):
     else:
         return DB_DIR / f'{db_name}_{username}_ratings.csv'
 
-def get_image_path(db_name, item_name):
-    """Check for image file for an item"""
+flush_lock = threading.Lock()
+
+def flush_ranker(ranker):
+    """Flush one ranker, logging a failed save rather than raising it"""
+    try:
+        ranker.flush()
+    except Exception:
+        # The ranker stays dirty and its journal intact, so the next flush retries
+        app.logger.exception('Could not save %s', ranker.csv_path)
+
+def flush_all():
+    """Write every ranker with unsaved changes to its CSV"""
+    with flush_lock:
+        for ranker in list(personal_rankers.values()):
+            flush_ranker(ranker)
+        for ranker in list(global_rankers.values()):
+            flush_ranker(ranker)
+
+def flush_user(username):
+    """Write one user's personal rankers now, e.g. when they log out"""
+    with flush_lock:
+        for (_, name), ranker in list(personal_rankers.items()):
+            if name == username:
+                flush_ranker(ranker)
+
+def flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_all()
+
+threading.Thread(target=flush_periodically, daemon=True).start()
+atexit.register(flush_all)
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp']  # in order of preference
+IMAGE_MAX_AGE = 86400  # seconds browsers may reuse an image without revalidating
+
+# Image URLs and files per database, rescanned when the images directory's mtime changes
+image_index = {}  # Key: db_name, value: (mtime_ns, {item_name: url}, {filename: path})
+
+def get_image_index(db_name):
+    """Return ({item_name: url}, {filename: path}) for a database's images"""
     img_dir = DB_DIR / db_name / 'images'
-    if not img_dir.exists():
-        return None
+    try:
+        mtime = img_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}, {}
     
-    for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-        img_path = img_dir / f'{item_name}{ext}'
-        if img_path.exists():
-            return f'/images/{db_name}/{item_name}{ext}'
-    return None
+    cached = image_index.get(db_name)
+    if cached is None or cached[0] != mtime:
+        images = [p for p in img_dir.iterdir() if p.suffix in IMAGE_EXTENSIONS]
+        images.sort(key=lambda p: IMAGE_EXTENSIONS.index(p.suffix))
+        urls = {}
+        for p in images:
+            urls.setdefault(p.stem, f'/images/{db_name}/{p.name}')
+        cached = (mtime, urls, {p.name: p for p in images})
+        image_index[db_name] = cached
+    return cached[1], cached[2]
+
+def pair_payload(db_name, pair):
+    """Names and image URLs for showing a pair, from a single index lookup"""
+    images, _ = get_image_index(db_name)
+    return {
+        'left': pair[0],
+        'right': pair[1],
+        'left_image': images.get(pair[0]),
+        'right_image': images.get(pair[1])
+    }
+
+@lru_cache(maxsize=64)
+def read_items(path, mtime_ns):
+    """Parse a database file; mtime_ns is only part of the cache key"""
+    return tuple(sys.intern(line) for line in Path(path).read_text().strip().split('\n'))
 
 def ensure_db_loaded(username):
     """Ensure at least one database is loaded for user"""
@@ -194,6 +603,22 @@ def ensure_db_loaded(username):
             load_database(databases[0], username)
             current_db[username] = databases[0]
 
+# Guards ranker creation so two first requests can't each build one
+rankers_lock = threading.RLock()
+
+def load_ranker(items, csv_file):
+    ranker = EloRanker(items)
+    ranker.csv_path = csv_file
+    ranker.load_from_csv(csv_file)
+    ranker.open_journal(csv_file.with_suffix('.journal'))
+    return ranker
+
+def load_global_ranker(db_name, items):
+    with rankers_lock:
+        if db_name not in global_rankers:
+            global_rankers[db_name] = load_ranker(items, get_csv_path(db_name, None, is_global=True))
+        return global_rankers[db_name]
+
 def load_database(db_name, username):
     global current_db, personal_rankers, global_rankers
     
@@ -201,55 +626,52 @@ def load_database(db_name, username):
     if not db_file.exists():
         return None
     
-    items = db_file.read_text().strip().split('\n')
+    items = read_items(str(db_file), db_file.stat().st_mtime_ns)
     
     # Load personal ranker
     personal_key = (db_name, username)
-    if personal_key not in personal_rankers:
-        ranker = EloRanker(items)
-        csv_file = get_csv_path(db_name, username, is_global=False)
-        ranker.load_from_csv(csv_file)
-        personal_rankers[personal_key] = ranker
+    with rankers_lock:
+        if personal_key not in personal_rankers:
+            csv_file = get_csv_path(db_name, username, is_global=False)
+            personal_rankers[personal_key] = load_ranker(items, csv_file)
     
-    # Load global ranker
-    if db_name not in global_rankers:
-        ranker = EloRanker(items)
-        csv_file = get_csv_path(db_name, username, is_global=True)
-        ranker.load_from_csv(csv_file)
-        global_rankers[db_name] = ranker
+    # Global rankers are normally built at startup; this catches databases added since
+    load_global_ranker(db_name, items)
     
     current_db[username] = db_name
     return personal_rankers[personal_key]
 
-def get_personal_ranker(username):
-    ensure_db_loaded(username)
-    db = current_db.get(username)
-    if not db:
-        return None
-    return personal_rankers.get((db, username))
+def user_context():
+    """The current user's database, personal ranker and global ranker, looked up once per request"""
+    if 'user_db' not in g:
+        username = current_user.username
+        ensure_db_loaded(username)
+        db = current_db.get(username)
+        g.user_db = db
+        g.personal_ranker = personal_rankers.get((db, username)) if db else None
+        g.global_ranker = global_rankers.get(db) if db else None
+    return g.user_db, g.personal_ranker, g.global_ranker
 
-def get_global_ranker(username):
-    ensure_db_loaded(username)
-    db = current_db.get(username)
-    if not db:
-        return None
-    return global_rankers.get(db)
+def warm_global_rankers():
+    """Build every database's global ranker at startup, not on a user's first request"""
+    for db_name in get_databases():
+        db_file = DB_DIR / f'{db_name}.txt'
+        load_global_ranker(db_name, read_items(str(db_file), db_file.stat().st_mtime_ns))
 
-def get_both_rankings(username):
-    """Get both personal and global rankings"""
-    ensure_db_loaded(username)
-    db = current_db.get(username)
-    
-    if not db:
-        return {'personal': [], 'global': []}
-    
-    personal = personal_rankers.get((db, username))
-    global_ranker = global_rankers.get(db)
+warm_global_rankers()
+
+def ojsonify(obj):
+    """Like jsonify, but encoded with orjson"""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+def get_both_rankings(limit=None):
+    """Get both personal and global rankings as a JSON body plus an ETag for it"""
+    _, personal, global_ranker = user_context()
     
-    return {
-        'personal': personal.get_rankings() if personal else [],
-        'global': global_ranker.get_rankings() if global_ranker else []
-    }
+    personal_json, personal_version = personal.get_rankings_json(limit) if personal else (b'[]', 0)
+    global_json, global_version = global_ranker.get_rankings_json(limit) if global_ranker else (b'[]', 0)
+    body = b'{"personal":%s,"global":%s}' % (personal_json, global_json)
+    return body, f'{personal_version}-{global_version}'
 
 HTML = """<!DOCTYPE html>
 <html>
@@ -557,7 +979,9 @@ HTML = """<!DOCTYPE html>
         }
         
         async function updateRankings() {
-            const resp = await fetch('/rankings');
+            // Only the top 10 are shown unless the full lists are open
+            const full = document.getElementById('fullRankings').style.display !== 'none';
+            const resp = await fetch(full ? '/rankings' : '/rankings?top=10');
             const data = await resp.json();
             
             // Personal top 10
@@ -814,55 +1238,74 @@ REGISTER_HTML = """<!DOCTYPE html>
 </body>
 </html>"""
 
+def encode_page(html):
+    """Encode and gzip a page once, with an ETag for conditional GETs"""
+    raw = html.encode('utf-8')
+    return raw, gzip.compress(raw, compresslevel=9), hashlib.sha1(raw).hexdigest()
+
+# The pages never change at runtime, so encode and compress them at import
+INDEX_PAGE = encode_page(HTML)
+LOGIN_PAGE = encode_page(LOGIN_HTML)
+REGISTER_PAGE = encode_page(REGISTER_HTML)
+
+def page_response(page):
+    raw, gz, etag = page
+    if request.accept_encodings['gzip']:
+        response = Response(gz, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gz')
+    else:
+        response = Response(raw, mimetype='text/html')
+        response.set_etag(etag)
+    # Revalidate every load so a redeploy shows up at once; unchanged pages are a 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
 @app.route('/')
 @login_required
 def index():
-    if 'sandbox' not in session:
-        session['sandbox'] = False  # Default to global mode
-    return HTML
+    return page_response(INDEX_PAGE)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'GET':
-        return LOGIN_HTML
+        return page_response(LOGIN_PAGE)
     
     data = request.json
-    conn = sqlite3.connect(USERS_DB)
-    c = conn.cursor()
-    c.execute('SELECT id, username, password_hash FROM users WHERE username = ?', (data['username'],))
-    user = c.fetchone()
-    conn.close()
+    with users_db_lock:
+        user = users_db.execute('SELECT id, username, password_hash FROM users WHERE username = ?',
+                                (data['username'],)).fetchone()
     
     if user and check_password_hash(user[2], data['password']):
         user_obj = User(user[0], user[1])
         login_user(user_obj)
-        return jsonify({'success': True})
+        session.setdefault('sandbox', False)  # Default to global mode
+        return ojsonify({'success': True})
     
-    return jsonify({'success': False, 'error': 'Invalid credentials'})
+    return ojsonify({'success': False, 'error': 'Invalid credentials'})
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'GET':
-        return REGISTER_HTML
+        return page_response(REGISTER_PAGE)
     
     data = request.json
-    conn = sqlite3.connect(USERS_DB)
-    c = conn.cursor()
+    password_hash = generate_password_hash(data['password'])
     
     try:
-        password_hash = generate_password_hash(data['password'])
-        c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', 
-                  (data['username'], password_hash))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
+        with users_db_lock:
+            users_db.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', 
+                             (data['username'], password_hash))
+            users_db.commit()
+        return ojsonify({'success': True})
     except sqlite3.IntegrityError:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Username already exists'})
+        return ojsonify({'success': False, 'error': 'Username already exists'})
 
 @app.route('/logout')
 @login_required
 def logout():
+    flush_user(current_user.username)
     logout_user()
     return redirect(url_for('login'))
 
@@ -870,7 +1313,7 @@ def logout():
 @login_required
 def get_session():
     ensure_db_loaded(current_user.username)
-    return jsonify({
+    return ojsonify({
         'username': current_user.username,
         'sandbox': session.get('sandbox', False)
     })
@@ -880,13 +1323,13 @@ def get_session():
 def set_sandbox():
     sandbox = request.json['sandbox']
     session['sandbox'] = sandbox
-    return jsonify({'success': True})
+    return ojsonify({'success': True})
 
 @app.route('/databases')
 @login_required
 def databases_endpoint():
     ensure_db_loaded(current_user.username)
-    return jsonify({
+    return ojsonify({
         'databases': get_databases(),
         'current': current_db.get(current_user.username)
     })
@@ -896,36 +1339,25 @@ def databases_endpoint():
 def switch_db():
     db_name = request.json['database']
     load_database(db_name, current_user.username)
-    return jsonify({'success': True})
+    return ojsonify({'success': True})
 
 @app.route('/set_strategy', methods=['POST'])
 @login_required
 def set_strategy():
     strategy = request.json['strategy']
-    ranker = get_personal_ranker(current_user.username)
+    _, ranker, _ = user_context()
     if ranker:
         ranker.strategy = strategy
-    return jsonify({'success': True})
+    return ojsonify({'success': True})
 
 @app.route('/get_pair')
 @login_required
 def get_pair():
-    ranker = get_personal_ranker(current_user.username)
-    db = current_db.get(current_user.username)
+    db, ranker, _ = user_context()
     
     if ranker and db:
-        pair = ranker.get_next_pair()
-        is_replaying = ranker.current_index < len(ranker.pair_sequence) - 1
-        return jsonify({
-            'left': pair[0],
-            'right': pair[1],
-            'left_image': get_image_path(db, pair[0]),
-            'right_image': get_image_path(db, pair[1]),
-            'is_replaying': is_replaying,
-            'current_index': ranker.current_index,
-            'sequence_length': len(ranker.pair_sequence)
-        })
-    return jsonify({
+        return ojsonify(ranker.next_payload(db))
+    return ojsonify({
         'left': '', 
         'right': '', 
         'left_image': None, 
@@ -945,98 +1377,108 @@ def submit_comparison():
     
     # Skip means don't count this comparison at all
     if result == 'tie':
-        return jsonify({'success': True})
+        return ojsonify({'success': True})
     
     sandbox = session.get('sandbox', False)
-    db = current_db.get(current_user.username)
+    db, personal_ranker, global_ranker = user_context()
     
-    if not db:
-        return jsonify({'success': False})
+    if not db or not personal_ranker:
+        return ojsonify({'success': False})
     
-    personal_ranker = get_personal_ranker(current_user.username)
-    if not personal_ranker:
-        return jsonify({'success': False})
+    # Swap in the ranker's own key strings and reject unknown items up front
+    left = personal_ranker.canonical_item(left)
+    right = personal_ranker.canonical_item(right)
+    if left is None or right is None or left == right:
+        return ojsonify({'success': False})
     
-    # Check if we're replaying history
-    is_replaying = personal_ranker.current_index < len(personal_ranker.pair_sequence) - 1
-    
-    # Update personal rankings
     if result == 'left':
-        personal_ranker.update_ratings(left, right)
+        winner, loser = left, right
     elif result == 'right':
-        personal_ranker.update_ratings(right, left)
-    
-    csv_file = get_csv_path(db, current_user.username, is_global=False)
-    personal_ranker.save_to_csv(csv_file)
+        winner, loser = right, left
+    else:
+        return ojsonify({'success': False})
     
-    # Only update global if not in sandbox and not replaying
-    if not sandbox and not is_replaying:
-        global_ranker = get_global_ranker(current_user.username)
-        if global_ranker:
-            if result == 'left':
-                global_ranker.update_ratings(left, right)
-            elif result == 'right':
-                global_ranker.update_ratings(right, left)
-            
-            csv_file = get_csv_path(db, current_user.username, is_global=True)
-            global_ranker.save_to_csv(csv_file)
+    # Hold the user's ranker for the whole check-and-update so concurrent
+    # requests from the same user can't interleave
+    with personal_ranker.lock:
+        # Reject a submission for a pair that isn't on screen, or was already
+        # rated (e.g. a held-down arrow key firing twice)
+        index = personal_ranker.current_index
+        if (index < 0 or personal_ranker.pair_sequence[index] != [left, right]
+                or personal_ranker.has_rating_at(index)):
+            return ojsonify({'success': False})
+        
+        # Check if we're replaying history
+        is_replaying = personal_ranker.is_replaying
+        
+        # Only update global if not in sandbox and not replaying
+        global_change = None
+        if not sandbox and not is_replaying and global_ranker:
+            global_change = global_ranker.update_ratings(winner, loser)
+        
+        # Update personal rankings, keeping the global change for go_back to revert
+        personal_ranker.update_ratings(winner, loser, global_change)
     
-    return jsonify({'success': True})
+    return ojsonify({'success': True})
 
 @app.route('/go_back', methods=['POST'])
 @login_required
 def go_back():
-    db = current_db.get(current_user.username)
-    
-    if not db:
-        return jsonify({'success': False})
-    
-    personal_ranker = get_personal_ranker(current_user.username)
-    if not personal_ranker:
-        return jsonify({'success': False})
+    db, personal_ranker, global_ranker = user_context()
     
-    # Store whether this index had a rating change before going back
-    had_rating_change = personal_ranker.current_index in personal_ranker.rating_change_indices
+    if not db or not personal_ranker:
+        return ojsonify({'success': False})
     
-    # Navigate back in personal ranker
-    pair = personal_ranker.go_back()
-    if not pair:
-        return jsonify({'success': False})
-    
-    # Save personal changes
-    csv_file = get_csv_path(db, current_user.username, is_global=False)
-    personal_ranker.save_to_csv(csv_file)
-    
-    # Only undo global if this pair actually changed ratings and we're not in sandbox
-    sandbox = session.get('sandbox', False)
-    if not sandbox and had_rating_change:
-        global_ranker = get_global_ranker(current_user.username)
-        if global_ranker and global_ranker.history:
-            global_ranker.ratings = global_ranker.history.pop()
-            if global_ranker.comparisons:
-                global_ranker.comparisons.pop()
-            
-            csv_file = get_csv_path(db, current_user.username, is_global=True)
-            global_ranker.save_to_csv(csv_file)
+    with personal_ranker.lock:
+        # Find the global change made by the rating being undone; sandbox and
+        # replayed ratings made none
+        global_change = personal_ranker.global_change_at(personal_ranker.current_index - 1)
+        
+        # Navigate back in personal ranker
+        pair = personal_ranker.go_back()
+        if not pair:
+            return ojsonify({'success': False})
+        
+        # Other users share the global ranker, so reverse just this user's
+        # change rather than popping its newest history entry
+        if global_change and global_ranker:
+            global_ranker.revert(global_change)
     
-    return jsonify({
+    return ojsonify({
         'success': True,
-        'left': pair[0],
-        'right': pair[1],
-        'left_image': get_image_path(db, pair[0]),
-        'right_image': get_image_path(db, pair[1])
+        **pair_payload(db, pair)
     })
 
 @app.route('/rankings')
 @login_required
 def rankings():
-    both = get_both_rankings(current_user.username)
-    return jsonify(both)
+    limit = request.args.get('top', type=int)
+    if limit is not None and limit <= 0:
+        limit = None
+    body, etag = get_both_rankings(limit)
+    response = Response(body, mimetype='application/json')
+    if request.accept_encodings['gzip'] and len(body) >= GZIP_MIN_SIZE:
+        etag += '-gz'
+        # Don't compress a body that make_conditional is about to drop for a 304
+        if not request.if_none_match.contains(etag):
+            response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    # Always revalidate, so unchanged rankings come back as an empty 304
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
 
 @app.route('/images/<db_name>/<filename>')
 def serve_image(db_name, filename):
-    img_dir = DB_DIR / db_name / 'images'
-    return send_from_directory(img_dir, filename)
+    # Only files found by the index scan are served, so no per-request path checks
+    path = get_image_index(db_name)[1].get(filename)
+    if path is None:
+        abort(404)
+    # Images reappear across many pairs; let the browser keep them for a day
+    # and revalidate by ETag after that
+    return send_file(path, max_age=IMAGE_MAX_AGE, conditional=True)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Set DEV=1 for the debugger and reloader
+    app.run(debug=bool(os.environ.get('DEV')), threaded=True)
\ No newline at end of file
@@ -0,0 +1,15 @@
+# Picked up automatically by `gunicorn app:app` when run from this directory
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+# Rankings live in this process's memory, so there must be exactly one worker;
+# concurrency comes from threads instead
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+
+timeout = 120
+
+# Rankers are written to disk by app.py's atexit hook; give it time to run
+graceful_timeout = 30
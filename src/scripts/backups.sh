@@ -6,8 +6,9 @@ TIMESTAMP=$(date +%Y%m%d_%H%M%S)
 
 mkdir -p "$BACKUP_DIR"
 
-# Backup users
-cp "$DB_DIR/users.db" "$BACKUP_DIR/users_$TIMESTAMP.db"
+# Backup users (users.db runs in WAL mode, so copy it through SQLite
+# rather than cp, which could miss changes still in users.db-wal)
+sqlite3 "$DB_DIR/users.db" ".backup '$BACKUP_DIR/users_$TIMESTAMP.db'"
 
 # Backup all global ratings (these are the shared community data)
 for csv in "$DB_DIR"/*_global_ratings.csv; do